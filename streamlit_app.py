@@ -1,8 +1,17 @@
+import csv
+import gzip
+import io
+import uuid
 import streamlit as st
 import pandas as pd
+import pyarrow.parquet as pq
 from google.cloud import bigquery
+from google.cloud import bigquery_storage
+from google.cloud import storage
+from google.auth.transport.requests import AuthorizedSession
 from google.oauth2 import service_account
-from datetime import datetime
+from requests.adapters import HTTPAdapter
+from datetime import datetime, timedelta
 import re
 
 # --- CONFIG ---
@@ -38,24 +47,267 @@ if not st.session_state.logged_in:
 
 # --- CONSTANTS ---
 PROJECT_ID = "trimark-tdp"
+# Characters stripped from uploaded CSV column names
+_CLEAN_RE = re.compile(r'[^\w\s]')
+# HTTP connections kept open by the shared BigQuery client
+HTTP_POOL_SIZE = 64
+# BigQuery types for preview dtype kinds when creating or replacing an upload table
+_UPLOAD_TYPES = {"i": "INTEGER", "u": "INTEGER", "f": "FLOAT", "b": "BOOLEAN"}
+# Valid names for new upload tables
+_BQ_ID = re.compile(r'^[A-Za-z0-9_]{1,1024}$')
+# Rows of a query result rendered on screen; the full result is only downloaded
+PREVIEW_ROWS = 1000
+# Parallel Storage API read streams used when downloading query results
+READ_STREAM_COUNT = 8
+# Queries scanning more than this must be confirmed before they run
+SCAN_CONFIRM_BYTES = 10 * 1000 ** 3
+# Download payloads kept in memory by run_download_query's cache
+DOWNLOAD_CACHE_ENTRIES = 4
+# Results larger than this are exported to GCS instead of passing through the app
+EXPORT_THRESHOLD_BYTES = 1024 ** 3
 
+@st.cache_resource(show_spinner=False)
+def load_credentials():
+    """Load the service account credentials shared by the BigQuery clients"""
+    if hasattr(st, 'secrets') and 'gcp_service_account' in st.secrets:
+        return service_account.Credentials.from_service_account_info(
+            st.secrets["gcp_service_account"]
+        )
+    return service_account.Credentials.from_service_account_file(
+        '/Users/trimark/Desktop/Jupyter_Notebooks/trimark-tdp-87c89fbd0816.json'
+    )
+
+@st.cache_resource(show_spinner=False)
 def init_bigquery_client():
-    """Initialize BigQuery client with service account credentials"""
-    try:
-        if hasattr(st, 'secrets') and 'gcp_service_account' in st.secrets:
-            credentials = service_account.Credentials.from_service_account_info(
-                st.secrets["gcp_service_account"]
-            )
-        else:
-            credentials = service_account.Credentials.from_service_account_file(
-                '/Users/trimark/Desktop/Jupyter_Notebooks/trimark-tdp-87c89fbd0816.json'
-            )
-        
-        client = bigquery.Client(credentials=credentials, project=PROJECT_ID)
-        return client
-    except Exception as e:
-        st.error(f"Error initializing BigQuery client: {str(e)}")
-        return None
+    """Initialize BigQuery client with service account credentials.
+
+    Cached so the client is built once and shared across reruns and sessions.
+    Errors are raised rather than returned so a failed attempt isn't cached.
+    """
+    credentials = load_credentials().with_scopes(bigquery.Client.SCOPE)
+    # The client is shared by every session, so give it a larger connection
+    # pool than the requests default of 10
+    http = AuthorizedSession(credentials)
+    http.mount("https://", HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE))
+    return bigquery.Client(credentials=credentials, project=PROJECT_ID, _http=http)
+
+@st.cache_resource(show_spinner=False)
+def init_bqstorage_client():
+    """Initialize the BigQuery Storage read client used to stream query results"""
+    return bigquery_storage.BigQueryReadClient(credentials=load_credentials())
+
+@st.cache_resource(show_spinner=False)
+def init_storage_client():
+    """Initialize the Cloud Storage client used for large exports"""
+    return storage.Client(credentials=load_credentials(), project=PROJECT_ID)
+
+def export_to_gcs(query_job, bucket_name, download_format):
+    """Extract a query's results to Parquet or gzipped CSV shards in GCS and return the blob names.
+
+    The app never deletes the shards; the export bucket needs a lifecycle rule
+    that removes objects under exports/ (e.g. after 1 day). See the README.
+    """
+    prefix = f"exports/{uuid.uuid4()}"
+    if download_format == "Parquet":
+        job_config = bigquery.ExtractJobConfig(
+            compression=bigquery.Compression.SNAPPY,
+            destination_format=bigquery.DestinationFormat.PARQUET,
+        )
+        extension = "parquet"
+    else:
+        job_config = bigquery.ExtractJobConfig(
+            compression=bigquery.Compression.GZIP,
+            destination_format=bigquery.DestinationFormat.CSV,
+        )
+        extension = "csv.gz"
+    init_bigquery_client().extract_table(
+        query_job.destination,
+        f"gs://{bucket_name}/{prefix}-*.{extension}",
+        job_config=job_config,
+        location=query_job.location,
+    ).result()
+
+    return [blob.name for blob in init_storage_client().list_blobs(bucket_name, prefix=prefix)]
+
+def signed_url(bucket_name, blob_name):
+    """Sign a one-hour V4 download URL for an exported shard"""
+    blob = init_storage_client().bucket(bucket_name).blob(blob_name)
+    return blob.generate_signed_url(version="v4", expiration=timedelta(hours=1), method="GET")
+
+def write_csv(rows, buffer):
+    """Stream query rows into a CSV buffer batch by batch, returning a preview of the first batch"""
+    preview_df = None
+    for batch in rows.to_arrow_iterable(
+        bqstorage_client=init_bqstorage_client(), max_stream_count=READ_STREAM_COUNT
+    ):
+        # Arrow-backed dtypes reuse the batch's buffers instead of boxing
+        # every string into a Python object
+        batch_df = batch.to_pandas(types_mapper=pd.ArrowDtype)
+        batch_df.to_csv(buffer, index=False, header=preview_df is None)
+        if preview_df is None:
+            preview_df = batch_df.head(PREVIEW_ROWS)
+    return preview_df
+
+def write_parquet(rows, buffer):
+    """Stream query rows as Arrow batches into a Parquet buffer, returning a preview of the first batch"""
+    preview_df = None
+    writer = None
+    for batch in rows.to_arrow_iterable(
+        bqstorage_client=init_bqstorage_client(), max_stream_count=READ_STREAM_COUNT
+    ):
+        if writer is None:
+            writer = pq.ParquetWriter(buffer, batch.schema, compression="snappy")
+            preview_df = batch.slice(0, PREVIEW_ROWS).to_pandas(types_mapper=pd.ArrowDtype)
+        writer.write_batch(batch)
+    if writer is not None:
+        writer.close()
+    return preview_df
+
+def clean_column_names(columns):
+    """Replace spaces with underscores and strip punctuation from column names.
+
+    Blank names become Unnamed_<position>. Repeated names are suffixed with a counter (a, a1, a2, ...). The comparison
+    ignores case, as BigQuery does.
+    """
+    cleaned = pd.Index(columns).str.replace(' ', '_', regex=False).str.replace(_CLEAN_RE, '', regex=True)
+    seen = set()
+    unique = []
+    for position, name in enumerate(cleaned):
+        # Blank headers get the same name pandas gives them ("Unnamed: 0" cleaned)
+        name = name or f"Unnamed_{position}"
+        candidate, i = name, 1
+        while candidate.lower() in seen:
+            candidate, i = f"{name}{i}", i + 1
+        seen.add(candidate.lower())
+        unique.append(candidate)
+    return unique
+
+def read_csv_header(file):
+    """Return the CSV's raw header line and the cleaned column names parsed from it"""
+    header_line = file.readline()
+    file.seek(0)
+    return header_line, clean_column_names(next(csv.reader([header_line.decode("utf-8-sig")])))
+
+def clean_csv_header(file):
+    """Return the CSV with its header row cleaned, reusing the file as-is when already clean"""
+    header_line, column_names = read_csv_header(file)
+    cleaned_line = io.StringIO()
+    csv.writer(cleaned_line, lineterminator="\n").writerow(column_names)
+    cleaned_header = cleaned_line.getvalue().encode("utf-8")
+    if cleaned_header == header_line.replace(b"\r\n", b"\n"):
+        return file
+    return io.BytesIO(cleaned_header + file.getbuffer()[len(header_line):])
+
+def upload_schema(column_names, preview_df):
+    """Build a load schema from the cleaned header, typed from the preview rows"""
+    return [
+        bigquery.SchemaField(name, _UPLOAD_TYPES.get(dtype.kind, "STRING"))
+        for name, dtype in zip(column_names, preview_df.dtypes)
+    ]
+
+def download_query_config(clients, start_date, end_date, **kwargs):
+    """Build the job config carrying the download query's parameters"""
+    return bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ArrayQueryParameter("clients", "STRING", list(clients)),
+            bigquery.ScalarQueryParameter("start_date", "DATE", start_date),
+            bigquery.ScalarQueryParameter("end_date", "DATE", end_date),
+        ],
+        **kwargs,
+    )
+
+@st.cache_data(ttl=1800, max_entries=DOWNLOAD_CACHE_ENTRIES, show_spinner=False)
+def run_download_query(query, clients, start_date, end_date, download_format):
+    """Run the download query and build the download payload, cached for 30 minutes.
+
+    Repeating the same selection is served from here, and BigQuery's own query
+    cache covers identical queries from other app instances. Only a few payloads
+    are kept since each one holds the whole download in memory.
+    """
+    bq_client = init_bigquery_client()
+    job_config = download_query_config(clients, start_date, end_date, use_query_cache=True)
+    query_job = bq_client.query(query, job_config=job_config)
+    rows = query_job.result()
+    export_bucket = st.secrets.get("export_bucket")
+
+    if export_bucket and bq_client.get_table(query_job.destination).num_bytes > EXPORT_THRESHOLD_BYTES:
+        # Large results go straight from BigQuery to GCS; the browser
+        # downloads the shards from signed URLs
+        return {
+            "total_rows": rows.total_rows,
+            "bucket": export_bucket,
+            "blob_names": export_to_gcs(query_job, export_bucket, download_format),
+            "format": download_format,
+        }
+
+    # Write each batch straight to the buffer so the full result
+    # never has to sit in memory as a single DataFrame
+    buffer = io.BytesIO()
+    if download_format == "Parquet":
+        preview_df = write_parquet(rows, buffer)
+        file_name, mime = "bigquery_data.parquet", "application/vnd.apache.parquet"
+    else:
+        # Parquet is already compressed; CSV is gzipped before it's sent to the browser
+        with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=4) as gz:
+            preview_df = write_csv(rows, gz)
+        file_name, mime = "bigquery_data.csv.gz", "application/gzip"
+
+    return {
+        "total_rows": rows.total_rows,
+        "preview_df": preview_df,
+        "data": buffer.getvalue(),
+        "format": download_format,
+        "file_name": file_name,
+        "mime": mime,
+    }
+
+@st.cache_data(ttl=3600, show_spinner="Loading clients…")
+def fetch_clients(table_path: str, client_col: str) -> list[str]:
+    """Return the sorted distinct clients in a table, cached for an hour.
+
+    If a small lookup table/materialized view is configured for the table under
+    `client_lookup_tables` in secrets, read from it instead of the fact table.
+    """
+    lookups = st.secrets.get("client_lookup_tables", {})
+    source_path = lookups.get(table_path, table_path)
+    client_query = f"SELECT {client_col} FROM `{source_path}` WHERE {client_col} IS NOT NULL GROUP BY 1"
+    clients_df = init_bigquery_client().query(client_query).to_dataframe(
+        bqstorage_client=init_bqstorage_client()
+    )
+    return sorted(clients_df[client_col].dropna().unique().tolist())
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def fetch_columns(table_path: str) -> dict[str, str]:
+    """Return a table's column names mapped to their data types, cached for an hour"""
+    project, dataset_id, table_id = table_path.split(".")
+    columns_query = f"""
+        SELECT column_name, data_type
+        FROM `{project}.{dataset_id}.INFORMATION_SCHEMA.COLUMNS`
+        WHERE table_name = @table_name
+        ORDER BY ordinal_position
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ScalarQueryParameter("table_name", "STRING", table_id)]
+    )
+    rows = init_bigquery_client().query(columns_query, job_config=job_config).result()
+    return {row["column_name"]: row["data_type"] for row in rows}
+
+def date_filter(data_type):
+    """Build the date range predicate without wrapping DATE/TIMESTAMP/DATETIME columns
+    in a function, so BigQuery can prune partitions"""
+    if data_type == "DATE":
+        return "date BETWEEN @start_date AND @end_date"
+    if data_type in ("TIMESTAMP", "DATETIME"):
+        return (
+            f"date >= {data_type}(@start_date) "
+            f"AND date < {data_type}(DATE_ADD(@end_date, INTERVAL 1 DAY))"
+        )
+    return "DATE(date) BETWEEN @start_date AND @end_date"
+
+@st.cache_data(ttl=300, show_spinner=False)
+def list_table_ids(project: str, dataset_id: str) -> list[str]:
+    """Return the table IDs in a dataset, cached for five minutes"""
+    return [table.table_id for table in init_bigquery_client().list_tables(f"{project}.{dataset_id}")]
 
 st.header(":arrow_down: Download CSV Export from BigQuery")
 st.info(
@@ -87,60 +339,111 @@ if selected_table in ["All Leads", "All Form Leads"]:
 else:
     client_col = "client_name"
 
-# Date inputs
-start_date = st.date_input("Start Date", datetime(2024, 1, 1), key="start_date")
-end_date = st.date_input("End Date", datetime.today(), key="end_date")
-
-# Initialize BigQuery client
-client = init_bigquery_client()
-if client is None:
+# Initialize BigQuery client (cached across reruns)
+try:
+    client = init_bigquery_client()
+except Exception as e:
+    st.error(f"Error initializing BigQuery client: {str(e)}")
     st.stop()
 
 # Fetch unique clients
-client_query = f"SELECT DISTINCT {client_col} FROM `{table_path}` WHERE {client_col} IS NOT NULL"
+if st.button("Refresh client list", key="refresh_clients"):
+    fetch_clients.clear()
+
 try:
-    clients_df = client.query(client_query).to_dataframe()
-    clients = sorted(clients_df[client_col].dropna().unique())
+    clients = fetch_clients(table_path, client_col)
+except Exception as e:
+    st.error(f"Could not fetch clients: {e}")
+    clients = []
+
+# Fetch the table's columns so only the selected ones are queried
+try:
+    columns = fetch_columns(table_path)
+except Exception as e:
+    st.warning(f"⚠️ Could not fetch columns, all columns will be downloaded: {e}")
+    columns = {}
+
+# --- FILTERS ---
+# Widgets inside the form don't rerun the app until the query is submitted
+with st.form("filters"):
+    start_date = st.date_input("Start Date", datetime(2024, 1, 1), key="start_date")
+    end_date = st.date_input("End Date", datetime.today(), key="end_date")
     selected_clients = st.multiselect(
         "Select one or more Clients", 
         clients, 
         key="client_multiselect"
     )
-except Exception as e:
-    st.error(f"Could not fetch clients: {e}")
-    selected_clients = []
+    selected_columns = st.multiselect(
+        "Select columns (leave empty for all)",
+        list(columns),
+        key="column_multiselect"
+    )
+    download_format = st.radio("Download Format", ["Parquet", "CSV"], horizontal=True, key="download_format")
+    allow_large_scan = st.checkbox(
+        f"Allow large scans (over {SCAN_CONFIRM_BYTES / 1e9:,.0f} GB)",
+        key="allow_large_scan"
+    )
+    submitted = st.form_submit_button("Run Query and Download")
 
 # --- QUERY & DOWNLOAD ---
-if st.button("Run Query and Download"):
+if submitted:
     if selected_clients:
+        # BigQuery column names are case-insensitive, e.g. `Date` on some tables
+        column_types = {name.lower(): data_type for name, data_type in columns.items()}
+        select_list = ", ".join(f"`{col}`" for col in selected_columns) or "*"
         query = f"""
-            SELECT *
+            SELECT {select_list}
             FROM `{table_path}`
             WHERE {client_col} IN UNNEST(@clients)
-              AND DATE(date) BETWEEN @start_date AND @end_date
+              AND {date_filter(column_types.get("date"))}
         """
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ArrayQueryParameter("clients", "STRING", selected_clients),
-                bigquery.ScalarQueryParameter("start_date", "DATE", start_date),
-                bigquery.ScalarQueryParameter("end_date", "DATE", end_date),
-            ]
-        )
         try:
-            df = client.query(query, job_config=job_config).to_dataframe()
-            st.dataframe(df)
-            csv = df.to_csv(index=False)
-            st.download_button("Download CSV", data=csv, file_name="bigquery_data.csv", mime="text/csv")
+            # Dry runs are free and report how much data the query would scan
+            dry_run_config = download_query_config(
+                selected_clients, start_date, end_date, dry_run=True, use_query_cache=False
+            )
+            scan_bytes = client.query(query, job_config=dry_run_config).total_bytes_processed
+
+            if scan_bytes > SCAN_CONFIRM_BYTES and not allow_large_scan:
+                st.session_state.pop("download_result", None)
+                st.warning(
+                    f"⚠️ This query will scan {scan_bytes / 1e9:,.1f} GB. "
+                    "Tick 'Allow large scans' and run it again to continue."
+                )
+            else:
+                with st.spinner("Running query…"):
+                    st.session_state["download_result"] = run_download_query(
+                        query, tuple(sorted(selected_clients)), start_date, end_date, download_format
+                    )
         except Exception as e:
+            st.session_state.pop("download_result", None)
             st.error(f"❌ Query failed: {e}")
     else:
         st.warning("Please select at least one client.")
 
-# --- UPLOAD TO BIGQUERY ---
-import re
-from google.cloud import bigquery
+# Results are kept in session state so the download survives reruns
+# (including the one triggered by clicking download) without re-querying
+result = st.session_state.get("download_result")
+if result is not None:
+    if "blob_names" in result:
+        # URLs are signed on each render so cached exports never hand out stale links
+        file_kind = "Parquet" if result["format"] == "Parquet" else "gzipped CSV"
+        st.caption(f"{result['total_rows']:,} rows exported in {len(result['blob_names'])} {file_kind} file(s). Links expire in 1 hour.")
+        for i, blob_name in enumerate(result["blob_names"], start=1):
+            st.link_button(f"Download part {i}", signed_url(result["bucket"], blob_name))
+    elif result["preview_df"] is None:
+        st.info("No rows matched the selected filters.")
+    else:
+        st.caption(f"Previewing {len(result['preview_df']):,} of {result['total_rows']:,} rows")
+        st.dataframe(result["preview_df"])
+        st.download_button(
+            f"Download {result['format']}",
+            data=result["data"],
+            file_name=result["file_name"],
+            mime=result["mime"],
+        )
 
-# --- Upload Section ---
+# --- UPLOAD TO BIGQUERY ---
 st.header("⬆️ Upload CSV to BigQuery")
 st.info(
     """Use this tool to upload CSV data to BigQuery. 
@@ -151,14 +454,17 @@ st.info(
 uploaded_file = st.file_uploader("Upload CSV", type="csv", key="file_uploader")
 
 if uploaded_file is not None:
-    df_upload = pd.read_csv(uploaded_file)
-
-    def clean_column_name(column_name):
-        column_name = column_name.replace(' ', '_')
-        column_name = re.sub(r'[^\w\s]', '', column_name)
-        return column_name
+    # Only a preview is parsed with pandas; the file itself is streamed to BigQuery
+    df_upload = pd.read_csv(uploaded_file, nrows=200)
+    uploaded_file.seek(0)
 
-    df_upload.columns = [clean_column_name(col) for col in df_upload.columns]
+    # Name the preview columns from the same cleaned header that is uploaded
+    _, column_names = read_csv_header(uploaded_file)
+    if len(column_names) == len(df_upload.columns):
+        df_upload.columns = column_names
+    else:
+        df_upload.columns = clean_column_names(df_upload.columns)
+    st.caption(f"Previewing the first {len(df_upload):,} rows")
     st.dataframe(df_upload)
 
     st.subheader("Upload Settings")
@@ -171,11 +477,12 @@ if uploaded_file is not None:
     )
 
     # Fetch existing tables
+    if st.button("Refresh table list", key="refresh_tables"):
+        list_table_ids.clear()
+
     existing_tables = []
     try:
-        dataset_ref = bigquery.DatasetReference(client.project, dataset_id)
-        tables_list = client.list_tables(dataset_ref)
-        existing_tables = [table.table_id for table in tables_list]
+        existing_tables = list_table_ids(client.project, dataset_id)
     except Exception as e:
         st.warning(f"⚠️ Could not fetch existing tables: {e}")
 
@@ -193,12 +500,28 @@ if uploaded_file is not None:
     }
 
     if st.button("Upload to BigQuery", key="upload_button"):
+        # Reject malformed new table names before starting a load job;
+        # existing tables come from BigQuery and are used as listed
+        if not table_id or (write_disposition == "Create new table" and not _BQ_ID.match(table_id)):
+            st.error("❌ Invalid table name. Use only letters, numbers and underscores.")
+            st.stop()
+
         table_ref = f"{client.project}.{dataset_id}.{table_id}"
-        job_config = bigquery.LoadJobConfig(write_disposition=disposition_map[write_disposition])
+        # Columns are matched to the table by header name. New and replaced
+        # tables get an explicit schema so the header is always used for names
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.CSV,
+            skip_leading_rows=1,
+            source_column_match=bigquery.enums.SourceColumnMatch.NAME,
+            write_disposition=disposition_map[write_disposition],
+        )
+        if write_disposition != "Append to existing table":
+            job_config.schema = upload_schema(column_names, df_upload)
 
         try:
-            job = client.load_table_from_dataframe(df_upload, table_ref, job_config=job_config)
+            job = client.load_table_from_file(clean_csv_header(uploaded_file), table_ref, job_config=job_config, rewind=True)
             job.result()
+            list_table_ids.clear()
             st.success(f"✅ Uploaded to `{table_ref}` using mode: {write_disposition}")
         except Exception as e:
             st.error(f"❌ Upload failed: {e}")